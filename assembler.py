@@ -10,66 +10,97 @@ from instructions import InstructionDefinition, ISADefinition
 from instructions import InvalidOperandException, InvalidOpcodeException, InvalidOperandNumberException
 import instructions
 from pathlib import Path
+import mmap
+import os
+import re
+import stat
+import struct
+import sys
+from typing import cast
+
+_LABEL_RE = re.compile(r'[A-Z][A-Z0-9]*:')
+_LABEL_BAD_RE = re.compile(r'[^A-Z0-9]')
+_TOK_RE = re.compile(r'\S+')
+#Whole-file patterns work on the raw bytes, only the non-blank lines get decoded
+_COMMENT_RE = re.compile(rb';[^\n]*')
+#One match per source line, run after comments are removed. Trailing whitespace is dropped and
+#the named group that matched gives the kind of line. Blank lines match none of the groups.
+_LINE_RE = re.compile(
+    rb'^(?:(?P<instr>    [^\n]*\S)|(?P<bad> [^\n]*\S)|(?P<label>[^\n]*\S))?[^\S\n]*$',
+    re.MULTILINE
+)
+
+class _TooManyErrors(Exception): pass
+
+#One encoded instruction field, (value, bitwidth). Label fields hold the label name until patched
+Field = tuple[int|str, int]
 
 class SourceLine:
-    def __init__(self, file: Path, linenumber: int, source: str):
+    __slots__ = ("file", "linenumber", "source", "kind", "_prefix", "_operand_cols")
+
+    def __init__(self, file: Path, linenumber: int, source: str, kind: str):
         self.file = file
         self.linenumber = linenumber
         self.source = source
+        self.kind = kind
+        #Only needed for error reporting, filled in by the first annotate call
+        self._prefix: str|None = None
+        self._operand_cols: list[int]|None = None
 
-    def is_instr(self):
+    def is_instr(self) -> bool:
         #Only valid to run once validate has correctly run
-        return self.source.startswith("    ")
+        return self.kind == "instr"
     
-    def validate(self):
+    def validate(self) -> str|None:
         index, msg = self.validate_form()
         if index is not None and msg is not None:
             return self.annotate(index=index, msg=msg)
         return None
 
-    def validate_form(self):
-        if self.source == "":
-            return None, None
-
-        if self.source.startswith("    "):
+    def validate_form(self) -> tuple[int|None,str|None]:
+        if self.kind == "instr":
             return self.validate_instruction_form()
         
-        if self.source[0] == " ":
+        if self.kind == "bad":
             return 0, "Invalid whitespace, labels must have zero indentation and instructions must have 4 spaces"
 
         #Label
-        for i, c in enumerate(self.source):
-            if i == 0 and c.isdigit():
-                return 0, "First digit of label cannot be an integer"
-            if i == len(self.source)-1 and c != ":":
-                return i, "Labels must end with a colon"
-            if i < len(self.source)-1 and not c.isupper() and not c.isdigit():
-                return i, "Labels can only contain integers and uppercase letters"
+        if self.source[0].isdigit():
+            return 0, "First digit of label cannot be an integer"
+        if _LABEL_RE.fullmatch(self.source):
+            return None, None
+
+        #Only search for the offending character once the fast match has failed
+        last = len(self.source)-1
+        if bad := _LABEL_BAD_RE.search(self.source, 0, last):
+            return bad.start(), "Labels can only contain integers and uppercase letters"
+        if self.source[last] != ":":
+            return last, "Labels must end with a colon"
 
         return None, None 
     
-    def validate_instruction_form(self):
+    def validate_instruction_form(self) -> tuple[int|None,str|None]:
         return None, None
 
-    def annotate(self, index=None, operand_index=None, msg=None):
+    def annotate(self, index: int|None = None, operand_index: int|None = None, msg: str|None = None) -> str:
         assert not (index and operand_index), "Cannot set both index and operand_index in an annotate call"
         if operand_index is not None:
             assert self.is_instr(), "Cannot set operand_index for non-instructions"
-            point = 4
-            seen = 0
-            last =  ""
-            for i in self.source[4:]:
-                if i != " " and last == " ": seen += 1
-                if seen==operand_index: break
-                last = i
-                point += 1
+            if self._operand_cols is None:
+                self._operand_cols = [m.start() for m in _TOK_RE.finditer(self.source)]
+            if operand_index < len(self._operand_cols):
+                point = self._operand_cols[operand_index]
+            else:
+                point = len(self.source)
                 
         elif index is not None:
             point = index
         else:
             point = None        
 
-        ret = f"{self.file}:{self.linenumber+1} "
+        if self._prefix is None:
+            self._prefix = f"{self.file}:{self.linenumber+1} "
+        ret = self._prefix
         offset = len(ret)
         ret += self.source + "\n"
         if point is not None or msg is not None:
@@ -84,136 +115,133 @@ class SourceLine:
         return ret
             
 class Block:
-    pass
+    __slots__ = ()
 
 class Program:
     def __init__(self, file: Path, isa: ISADefinition):
         self.file = file
         self.isa = isa
-        self.source_lines: list[SourceLine] = []
-        with self.file.open() as f:
-            for i, line in enumerate(f):
-                comment = line.find(";")
-                if comment != -1:
-                    line = line[:line.find(";")]
-                line = line.rstrip()
-                sl = SourceLine(self.file, i, line)
-                if msg := sl.validate():
-                    print(msg)
-                if sl.source:
-                    self.source_lines.append(sl)
+        #Bound once, called for every instruction
+        self._match = isa.match
+        #Messages are collected here and written out in one go by flush_errors
+        self.errors: list[str] = []
+        with self.file.open("rb") as f:
+            st = os.fstat(f.fileno())
+            if stat.S_ISREG(st.st_mode) and st.st_size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    text = _COMMENT_RE.sub(b"", mm)
+            else:
+                #Empty files, pipes and other non-regular files cannot be mapped
+                text = _COMMENT_RE.sub(b"", f.read())
+        #Sized for the worst case of no blank lines, trimmed once all lines are seen
+        lines: list[SourceLine|None] = [None]*(text.count(b"\n")+1)
+        line_count = 0
+        for i, m in enumerate(_LINE_RE.finditer(text)):
+            kind = m.lastgroup
+            if kind is None:
+                continue
+            sl = SourceLine(self.file, i, m.group(kind).decode(), kind)
+            if msg := sl.validate():
+                self.errors.append(msg)
+            lines[line_count] = sl
+            line_count += 1
+        del lines[line_count:]
+        self.source_lines = cast(list[SourceLine], lines)
         
-        self.instructions = []
+        #Source line of each instruction, indexed the same as the output words. Kept for annotating
+        #undefined labels once every label is known
+        self.instr_sls: list[SourceLine] = []
+        words: list[int] = []
+        #Label operands are emitted as zero and patched in once every label is known.
+        #Each entry is (word index, operand index, field shift, label name)
+        pending_patches: list[tuple[int,int,int,str]] = []
         error_count = 0
         next_label_name = None
-        self.label_store = {}
-        for sl in self.source_lines:
-            if not sl.is_instr():
-                next_label_name = sl.source[:-1] #hacky, but should be validated to this form already
-                if next_label_name in self.label_store:
-                    error_count+=1
-                    print(sl.annotate(index=0, msg=f"Invalid reuse of a label '{next_label_name}'"))
-                continue
+        self.label_store: dict[str,int] = {}
+        try:
+            for sl in self.source_lines:
+                if sl.kind != "instr":
+                    #hacky, but should be validated to this form already. Interned so lookups of the
+                    #matching (also interned) label operands hit on identity
+                    next_label_name = sys.intern(sl.source[:-1])
+                    if next_label_name in self.label_store:
+                        error_count+=1
+                        self.errors.append(sl.annotate(index=0, msg=f"Invalid reuse of a label '{next_label_name}'"))
+                        if error_count > 5:
+                            raise _TooManyErrors
+                    continue
             
-            #Valid is bool.
-            #Encoding is 1-4 entry list. Each entry is (value, bitwidth). Opcode, registers, and immediates are encoded.
-            #Label ref gives an index of the encoding that contains a label. 0 for none
-            valid, encoding, label_ref = self.get_encoding(sl)
+                #None if the line is invalid, otherwise the encoding and matched definition.
+                #Encoding is 1-4 entry list. Each entry is (value, bitwidth). Opcode, registers, and immediates are encoded.
+                #Instr def is the matched definition, giving the label index and field shifts
+                result = self.get_encoding(sl)
             
-            if valid:
-                if next_label_name:
-                    self.label_store[next_label_name] = len(self.instructions)
-                self.instructions.append((next_label_name,sl,encoding,label_ref))
-                next_label_name = None
-            else:
-                error_count+=1
-
-            if error_count > 5:
-                print("Reached max error count, exiting.")
-                exit(1)
+                if result is not None:
+                    encoding, instr_def = result
+                    n = len(words)
+                    if next_label_name:
+                        self.label_store[next_label_name] = n
+                    if label_ref := instr_def.label_index:
+                        pending_patches.append((n, label_ref, instr_def.shifts[label_ref], cast(str, encoding[label_ref][0])))
+                        encoding[label_ref] = (0, encoding[label_ref][1])
+                    words.append(instr_def.pack(encoding))
+                    self.instr_sls.append(sl)
+                    next_label_name = None
+                else:
+                    error_count+=1
+                    if error_count > 5:
+                        raise _TooManyErrors
+        except _TooManyErrors:
+            self.errors.append("Reached max error count, exiting.")
+            self.flush_errors()
+            exit(1)
 
 
-        for label_name, sl, encoding, label_ref in self.instructions:
-            if label_ref and encoding[label_ref][0] not in self.label_store:
-                print(sl.annotate(operand_index=label_ref, msg=f"Label {encoding[label_ref][0]} is used, but not defined anywhere in the program."))
+        for n, label_ref, shift, label_name in pending_patches:
+            if label_name not in self.label_store:
+                self.errors.append(self.instr_sls[n].annotate(operand_index=label_ref, msg=f"Label {label_name} is used, but not defined anywhere in the program."))
                 error_count += 1
-            elif label_ref:
+            else:
                 #mult by 4 to account for alignment
-                encoding[label_ref] = (4*self.label_store[encoding[label_ref][0]],encoding[label_ref][1])
+                words[n] |= 4*self.label_store[label_name] << shift
 
         if error_count:
-            print("Encoding generation completed with errors, exiting.")
+            self.errors.append("Encoding generation completed with errors, exiting.")
+            self.flush_errors()
             exit(1)
 
         #At this point we have confidence all instructions are well-formed and all labels are valid
-        self.output = []
-        for label_name, sl, encoding, label_ref in self.instructions:
-            val = 0
-            total_width = 0
-            for (value, width) in encoding[::-1]:
-                val |= value << total_width
-                total_width += width
-            assert total_width == 32, f"{sl.file}:{sl.linenumber+1} Got total width of {total_width}"
-            self.output.append(val)
-
         #Program region marker
-        self.output.append(0xFFFFFFFF)
+        words.append(0xFFFFFFFF)
+        #Serialise the whole program in one call
+        self.output = struct.pack(f"<{len(words)}I", *words)
+        self.flush_errors()
+
+    def flush_errors(self):
+        if self.errors:
+            sys.stdout.write("\n".join(self.errors) + "\n")
+            self.errors.clear()
         
-    def get_encoding(self, sourceline):
+    def get_encoding(self, sourceline: SourceLine) -> tuple[list[Field],InstructionDefinition]|None:
         #assume all inputs are well-formed instructions, not empty or labels
-        ops = [i for i in sourceline.source.split() if i]
-        valid, result = self.isa.match(ops[0], *ops[1:])
-        if not valid:
+        ops = _TOK_RE.findall(sourceline.source)
+        _, result = self._match(ops[0], *ops[1:])
+        if not isinstance(result, InstructionDefinition):
             operand_index, msg = result
-            msg = sourceline.annotate(operand_index=operand_index, msg=msg)
-            print(msg)
-            return False, None, None
-
-        def imm_to_int(imm):
-            if len(imm) >= 3 and imm[0:2] == "0x" and (i.isdigit() for i in imm[2:]):
-                return int(imm, base=16)
-            return int(imm)
+            self.errors.append(sourceline.annotate(operand_index=operand_index, msg=msg))
+            return None
 
         instr_def = result
-        label_index = 0
-        encoding = [(instr_def.encoding,8)] 
-        for i, o in enumerate(instr_def.ops):
-            match o:
-                case instructions.OperandType.REG:
-                    encoding.append((self.isa.get_reg_encoding(ops[i+1]),8))
-                case instructions.OperandType.LAB:
-                    encoding.append((ops[i+1],24)) #Labels are always 24 bits
-                    label_index = i+1
-                case instructions.OperandType.IMM16:
-                    value = imm_to_int(ops[i+1])
-                    width = 16
-                    if value >= 2**width:
-                        msg = f"Literal value {value} is too big for 16-bit literal."
-                        msg = sourceline.annotate(operand_index=operand_index, msg=msg)
-                        print(msg)
-                        return False, None, None
-                    encoding.append((value,width))
-                case instructions.OperandType.IMM24:
-                    value = imm_to_int(ops[i+1])
-                    width = 24
-                    if value >= 2**width:
-                        msg = f"Literal value {value} is too big for 24-bit literal."
-                        msg = sourceline.annotate(operand_index=operand_index, msg=msg)
-                        print(msg)
-                        return False, None, None
-                    encoding.append((value,width))
-                case _:
-                    assert False, "Unexpected operand value"
-
-        #Required for standalone instructions
-        if not instr_def.ops:
-            encoding.append((0,24))
-        if instr_def.ops == [instructions.OperandType.REG]:
-            encoding.append((0,16))
-        if instr_def.ops == [instructions.OperandType.REG,instructions.OperandType.REG]:
-            encoding.append((0,8))
-
-        return True, encoding, label_index
+        encoding: list[Field] = [(instr_def.encoding,8)] 
+        try:
+            for encoder, op in zip(instr_def.encoders, ops[1:]):
+                encoding.append(encoder(op))
+        except InvalidOperandException as e:
+            #Encoding holds the opcode and each operand before the failing one
+            self.errors.append(sourceline.annotate(operand_index=len(encoding), msg=str(e)))
+            return None
+
+        return encoding, instr_def
 
 def get_args():
     parser = ArgumentParser()
@@ -225,9 +253,7 @@ def get_args():
     return parser.parse_args()
 
 def write_out(program: Program, path: Path):
-    with path.open("wb") as f:
-        for instr in program.output:
-            f.write(instr.to_bytes(4,'little'))
+    path.write_bytes(program.output)
 
 def main():
     args = get_args()
@@ -4,12 +4,20 @@ Create definitions based off yaml file input. Used as library and standalone
 """
 
 from __future__ import annotations
-from dataclasses import dataclass
-from yaml import safe_load
+from yaml import load as yaml_load
+try:
+    from yaml import CSafeLoader as _Loader
+except ImportError:
+    from yaml import SafeLoader as _Loader
 from pathlib import Path
 from enum import IntEnum
+from functools import lru_cache, partial
+from hashlib import blake2b
+import re
+import marshal
+import sys
 
-OPTYPES = ["REG","LAB","IMM","IMM16","IMM24"]
+OPTYPES = [sys.intern(s) for s in ("REG","LAB","IMM","IMM16","IMM24")]
 class OperandType(IntEnum):
     REG=0
     LAB=1
@@ -17,6 +25,32 @@ class OperandType(IntEnum):
     IMM16=3
     IMM24=4
 
+#Short form of each operand type used in internal names, e.g. IMM16 -> I16
+_OPTYPE_ABBREV = tuple(s[0]+s[3:5] for s in OPTYPES)
+
+#Operand types allowed in an ISA file. IMM is only used when parsing assembly
+_OP_NAME_TO_TYPE = {
+    "REG": OperandType.REG,
+    "LAB": OperandType.LAB,
+    "IMM16": OperandType.IMM16,
+    "IMM24": OperandType.IMM24,
+}
+
+_VALID_INSTR_KEYS = frozenset(("name", "ops", "flags", "desc"))
+_OPTYPES_SET = frozenset(OPTYPES)
+
+_LAB_RE = re.compile(r'[A-Z][A-Z0-9]*')
+#Decimal, or anything after a 0x prefix which imm_to_int then parses as hex
+_IMM_RE = re.compile(r'\d+|0x\S+')
+
+#Encoded bitwidth of each operand type, IMM is never encoded
+OPWIDTHS = {
+    OperandType.REG: 8,
+    OperandType.LAB: 24,
+    OperandType.IMM16: 16,
+    OperandType.IMM24: 24,
+}
+
 def load_from_yaml(path: str|Path) -> dict:
     if isinstance(path, str):
         path = Path(path)
@@ -24,8 +58,27 @@ def load_from_yaml(path: str|Path) -> dict:
     if not path.exists():
         raise FileNotFoundError(f"Yaml file {path} cannot be found")
 
-    with path.open() as f:
-        data = safe_load(f)
+    raw = path.read_bytes()
+    #Parsed data is cached next to the yaml along with a hash of its content, and reused while
+    #the hash matches. Unlike mtimes this survives checkouts and copies
+    digest = blake2b(raw, digest_size=16).digest()
+    #marshal only round-trips plain data, so unlike pickle a tampered cache cannot run code
+    cache = path.with_suffix(path.suffix + ".cache.marshal")
+    try:
+        cached_digest, data = marshal.loads(cache.read_bytes())
+        if cached_digest == digest:
+            return data
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+
+    data = yaml_load(raw, Loader=_Loader)
+
+    try:
+        cache.write_bytes(marshal.dumps((digest, data)))
+    except (OSError, ValueError):
+        #Cache is only an optimisation, e.g. the yaml may be in a read-only directory or hold
+        #values marshal cannot store
+        pass
 
     return data
 
@@ -33,28 +86,107 @@ class InstructionFormatException(Exception): pass
 class InvalidOpcodeException(InstructionFormatException): pass
 class InvalidOperandException(InstructionFormatException): pass
 class InvalidOperandNumberException(InvalidOperandException): pass
+
+def imm_to_int(imm: str) -> int:
+    try:
+        if len(imm) >= 3 and imm[0:2] == "0x":
+            return int(imm, base=16)
+        return int(imm)
+    except ValueError:
+        raise InvalidOperandException(f"Could not parse literal value {imm}.") from None
+
+IMM16_MAX = 1 << 16
+IMM24_MAX = 1 << 24
+
+def _encode_imm(imm: str, width: int, limit: int) -> tuple[int,int]:
+    value = imm_to_int(imm)
+    if value >= limit:
+        raise InvalidOperandException(f"Literal value {value} is too big for {width}-bit literal.")
+    return value, width
+
+#Width and limit are bound once, so encoders are called with just the operand
+encode_imm16 = partial(_encode_imm, width=16, limit=IMM16_MAX)
+encode_imm24 = partial(_encode_imm, width=24, limit=IMM24_MAX)
+
+def make_packer(shifts: tuple[int,...]):
+    """
+    Build a function ORing an encoding's field values into one instruction word, specialised on the field count
+    """
+    match shifts:
+        case (s0,):
+            return lambda enc: enc[0][0] << s0
+        case (s0, s1):
+            return lambda enc: enc[0][0] << s0 | enc[1][0] << s1
+        case (s0, s1, s2):
+            return lambda enc: enc[0][0] << s0 | enc[1][0] << s1 | enc[2][0] << s2
+        case (s0, s1, s2, s3):
+            return lambda enc: enc[0][0] << s0 | enc[1][0] << s1 | enc[2][0] << s2 | enc[3][0] << s3
+        case _:
+            #Longer encodings cannot fit in 32 bits, so are never packed when assembling. They
+            #still get a general packer as the ISA is allowed to define them
+            def pack(enc):
+                word = 0
+                for (value, _), shift in zip(enc, shifts):
+                    word |= value << shift
+                return word
+            return pack
+
+class _OperandTypeCache(dict):
+    """
+    Operand type of each operand string seen so far, classified on first use
+    """
+    def __init__(self, classify):
+        super().__init__()
+        self.classify = classify
+
+    def __missing__(self, operand: str) -> OperandType:
+        #Unclassifiable operands raise here and are never stored
+        optype = self[operand] = self.classify(operand)
+        return optype
+
 class InstructionDefinition:
+    __slots__ = ("name", "ops", "flags", "desc", "encoding", "internal_name", "ops_normalized",
+                 "encoders", "label_index", "shifts", "pack")
+
     def __init__ (self, name, ops, flags, desc, encoding):
         self.name = name
         self.ops = ops
         self.flags = flags
         self.desc = desc
         self.encoding = encoding           
+        #Filled in by ISADefinition once registers are known. One callable per operand, taking the
+        #operand string and returning its (value, bitwidth) field
+        self.encoders: tuple = ()
+        #Operand types as seen by the parser, which cannot tell IMM16 from IMM24
+        self.ops_normalized: tuple[OperandType,...] = tuple(OperandType.IMM if o in (OperandType.IMM16, OperandType.IMM24) else o for o in ops)
+        #Index into the encoding of the label operand, 0 for none
+        self.label_index = self.ops.index(OperandType.LAB)+1 if OperandType.LAB in self.ops else 0
+        #Left shift of the opcode and each operand within the 32-bit instruction word, unused low bits are 0.
+        #Definitions too wide to encode still load, for the generated defs, and are rejected when assembling
+        shifts = [24]
+        for o in self.ops:
+            shifts.append(shifts[-1] - OPWIDTHS[o])
+        self.shifts = tuple(shifts)
+        self.pack = make_packer(self.shifts)
         self.internal_name: str = self.name
         if self.ops: 
-            self.internal_name += "_" + "_".join([OPTYPES[o][0]+OPTYPES[o][3:5] for o in self.ops])
+            self.internal_name += "_" + "_".join(_OPTYPE_ABBREV[o] for o in self.ops)
         self.internal_name = self.internal_name.replace(".","_")
 
     def __eq__(self, other: InstructionDefinition):
         return self.name == other.name and self.ops == other.ops
 
+    def __hash__(self):
+        return hash((self.name, self.ops))
+
 class InstructionArray:
     def __init__(self, data: list, initial_encoding: int):
         self.data = data 
         self.instructions: list[InstructionDefinition] = []
         self.next_encoding = initial_encoding
-        self.valid_keys = ["name", "ops", "flags", "desc"]
         self.prefix = []
+        #(name, ops) of each parsed instruction, for duplicate detection
+        self._seen: set[tuple[str,tuple[OperandType,...]]] = set()
 
     def set_prefix(self, prefix: str|list[str]):
         if isinstance(prefix, str):
@@ -65,9 +197,10 @@ class InstructionArray:
         for i, instr in enumerate(self.data):
             if not isinstance(instr, dict):
                 return (False, f"Instruction list entry {i}. Expected type of entry to be a dict, found {type(instr)}")
-            for k, v in instr.items():
-                if k not in self.valid_keys:
-                    return (False, f"Instruction list entry {i}. Found invalid key '{k}'")
+            if bad := instr.keys() - _VALID_INSTR_KEYS:
+                #Report the first in file order, set order is arbitrary
+                k = next(k for k in instr if k in bad)
+                return (False, f"Instruction list entry {i}. Found invalid key '{k}'")
             if "name" not in instr:
                 return (False, f"Instruction list entry {i}. Missing required key 'name'")
             if "desc" not in instr:
@@ -76,12 +209,19 @@ class InstructionArray:
                 if not isinstance(instr["ops"], list):
                     return (False, f"Instruction list entry {i}. Value of ops must be a list")
                 for op_ind, op in enumerate(instr["ops"]):
-                    if op not in OPTYPES:
+                    if not isinstance(op, str) or op not in _OPTYPES_SET:
                         return (False, f"Instruction list entry {i}, op entry {op_ind}. {op} is not a valid operand type")
+            if "flags" in instr:
+                if not isinstance(instr["flags"], list):
+                    return (False, f"Instruction list entry {i}. Value of flags must be a list")
+                for flag_ind, flag in enumerate(instr["flags"]):
+                    #Flags are looked up in a set when parsing, so must be hashable
+                    if not isinstance(flag, str):
+                        return (False, f"Instruction list entry {i}, flag entry {flag_ind}. Expected type of flag to be a str, found {type(flag)}")
         
         return True, ""
     
-    def parse(self, flag_defs):
+    def parse(self, flag_defs, shared_tuples: dict[tuple,tuple]):
         if self.prefix:
             prefix = ".".join(self.prefix) + "."
         else:
@@ -89,24 +229,27 @@ class InstructionArray:
 
         for i, instr in enumerate(self.data):
             name = prefix + instr["name"]
-            ops = []
-            for op in instr.get("ops", []):
-                if op == "REG": ops.append(OperandType.REG)
-                elif op == "LAB": ops.append(OperandType.LAB)
-                elif op == "IMM": 
-                    return (False, f"Instruction list entry i specifies an IMM operand which is not legal.")
-                elif op == "IMM16": ops.append(OperandType.IMM16)
-                elif op == "IMM24": ops.append(OperandType.IMM24)
+            ops = instr.get("ops", [])
+            if "IMM" in ops:
+                return (False, f"Instruction list entry {i} specifies an IMM operand which is not legal.")
+            #validate has already rejected unknown names
+            ops = tuple(_OP_NAME_TO_TYPE[op] for op in ops)
+            #Many definitions have the same operands, they all share one tuple
+            ops = shared_tuples.setdefault(ops, ops)
 
             flags = instr.get("flags", [])
             for f in flags:
                 if f not in flag_defs:
                     return (False, f"Instruction list entry {i} uses unknown flag {f}.")
+            flags = tuple(flags)
+            flags = shared_tuples.setdefault(flags, flags)
 
             desc = instr["desc"]
-            new_instr = InstructionDefinition(name, ops, flags, desc, self.next_encoding)
-            if new_instr in self.instructions:
+            key = (name, ops)
+            if key in self._seen:
                 return (False, f"Instruction list entry {i} is a duplicated definition.")
+            self._seen.add(key)
+            new_instr = InstructionDefinition(name, ops, flags, desc, self.next_encoding)
             self.instructions.append(new_instr)
             self.next_encoding += 1
         return True, ""
@@ -126,11 +269,11 @@ class Pipe:
         self.encoding_prefix = initial_encoding >> 4
 
     def validate(self):
-        if "name" not in self.data.keys():
+        if "name" not in self.data:
             return (False, f"Could not find top level pipe key 'name'")
-        if "prefix" not in self.data.keys():
+        if "prefix" not in self.data:
             return (False, f"Could not find top level pipe key 'prefix'")
-        if "instructions" not in self.data.keys():
+        if "instructions" not in self.data:
             return (False, f"Could not find top level pipe key 'instructions'")
 
         self.instructions = InstructionArray(self.data["instructions"], self.next_encoding)
@@ -145,7 +288,7 @@ class Pipe:
         self.prefix = self.data["prefix"]
 
         self.instructions.set_prefix(["P", self.prefix])
-        valid, err = self.instructions.parse(isa.flags)
+        valid, err = self.instructions.parse(isa._flags_set, isa._shared_tuples)
         if not valid:
             return False, err
 
@@ -160,9 +303,25 @@ class ISADefinition:
         self.next_encoding = 0
         self.instructions: InstructionArray = None
         self.flags: list[str] = []
+        self._flags_set: set[str] = set()
         self.registers: list[str] = []
+        self._reg_index: dict[str,int] = {}
+        #Encoded (value, bitwidth) field of each register, they never change so are shared between uses
+        self._reg_fields: dict[str,tuple[int,int]] = {}
+        #Candidate definitions for each opcode name, and for each (name, operand count)
+        self._by_name: dict[str,list[InstructionDefinition]] = {}
+        self._by_name_arity: dict[tuple[str,int],list[InstructionDefinition]] = {}
+        #Assembly reuses the same registers, labels and literals, so each distinct operand is
+        #classified once and later lookups stay in C
+        self._operand_types = _OperandTypeCache(self.get_operand_type)
+        #match results for each (opcode, operand types) seen so far
+        self._resolved: dict[tuple[str,tuple[OperandType,...]],tuple] = {}
         self.data = data
         self.pipes: list[Pipe] = []
+        #Canonical copy of each distinct operand and flag tuple used by the instructions
+        self._shared_tuples: dict[tuple,tuple] = {}
+        #Core then pipe instructions in encoding order, filled in once parsing finishes
+        self.instructions_flat: list[InstructionDefinition] = []
         self.memory_size = None
         self.memory_width = None
 
@@ -180,13 +339,13 @@ class ISADefinition:
         """
         Validate the form of the data, does not do semantic checking
         """
-        if "instructions" not in self.data.keys():
+        if "instructions" not in self.data:
             return (False, f"Could not find top level key 'instructions'")
-        if "registers" not in self.data.keys():
+        if "registers" not in self.data:
             return (False, f"Could not find top level key 'registers'")
-        if "flags" not in self.data.keys():
+        if "flags" not in self.data:
             return (False, f"Could not find top level key 'flags'")
-        if "memory" not in self.data.keys():
+        if "memory" not in self.data:
             return (False, f"Could not find top level key 'memory'")
 
         if not isinstance(self.data["registers"], list):
@@ -208,6 +367,8 @@ class ISADefinition:
                 return (False, f"Flag list entry {i}. Missing required key 'flag'")
             if "name" not in flag:
                 return (False, f"Flag list entry {i}. Missing required key 'name'")
+            if not isinstance(flag["flag"], str):
+                return (False, f"Flag list entry {i}. Expected type of flag to be a str, found {type(flag['flag'])}")
         for k, v in self.data["memory"].items():
             if not isinstance(k, str):
                 return (False, f"Memory entry {k}. Expected type of key to be a str, found {type(k)}")
@@ -223,7 +384,7 @@ class ISADefinition:
             return False, err
 
         next_pipe_encoding = 128
-        if "pipes" in self.data.keys():
+        if "pipes" in self.data:
             if not isinstance(self.data["pipes"], list):
                 return (False, f"Expected value of 'pipes' to be a list, found {type(self.data['pipes'])}")
             for i, pipe in enumerate(self.data["pipes"]):
@@ -240,18 +401,24 @@ class ISADefinition:
 
     def _parse(self):
         for i, reg in enumerate(self.data["registers"]):
-            if reg in self.registers:
+            reg = sys.intern(reg)
+            if reg in self._reg_index:
                 return (False, f"Register list entry {i} is duplicated.")
-            self.registers.append(reg)
+            #Any duplicate stops parsing, so the entry number is the encoding
+            self._reg_index[reg] = i
+            self._reg_fields[reg] = (i, 8)
+        #The index is built in file order, so it doubles as the ordered register list
+        self.registers = list(self._reg_index)
         for i, flag in enumerate(self.data["flags"]):
-            flag = flag["flag"]
-            if flag in self.flags:
+            flag = sys.intern(flag["flag"])
+            if flag in self._flags_set:
                 return (False, f"Flag list entry {i} is duplicated.")
+            self._flags_set.add(flag)
             self.flags.append(flag)
         self.memory_size = self.data["memory"]["size"]
         self.memory_width = self.data["memory"]["width"]
 
-        valid, err = self.instructions.parse(self.flags)
+        valid, err = self.instructions.parse(self._flags_set, self._shared_tuples)
         if not valid:
             return False, err
 
@@ -260,76 +427,112 @@ class ISADefinition:
             if not valid:
                 return False, err
 
+        self.instructions_flat = list(self.instructions.instructions)
+        for p in self.pipes:
+            self.instructions_flat.extend(p.instructions.instructions)
+
+        for instr in self.instructions_flat:
+            instr.encoders = tuple(self._make_encoder(o) for o in instr.ops)
+            self._by_name.setdefault(instr.name, []).append(instr)
+            self._by_name_arity.setdefault((instr.name, len(instr.ops)), []).append(instr)
+
         return True, ""
 
-    def match(self, opcode_str: str, *ops) -> tuple[bool,tuple[int,str]|InstructionDefinition]:
-        trial: list[InstructionDefinition] = []
-        for i in self.all_instructions():
-            if i.name == opcode_str:
-                trial.append(i)
-        
-        if not trial:
-            return False, (0, f"Unknown opcode '{opcode_str}'")
+    def _make_encoder(self, optype: OperandType):
+        match optype:
+            case OperandType.REG:
+                return self._reg_fields.__getitem__
+            case OperandType.LAB:
+                return lambda label: (sys.intern(label), 24) #Labels are always 24 bits, resolved by the assembler
+            case OperandType.IMM16:
+                return encode_imm16
+            case OperandType.IMM24:
+                return encode_imm24
+            case _:
+                assert False, "Unexpected operand value"
 
-        filtered_trial = [t for t in trial if len(t.ops) == len(ops)]
+    def match(self, opcode_str: str, *ops) -> tuple[bool,tuple[int,str]|InstructionDefinition]:
+        #A well-formed line needs only the one lookup, the name index is just for telling the errors apart
+        trial = self._by_name_arity.get((opcode_str, len(ops)))
 
-        if not filtered_trial:
+        if not trial:
+            if opcode_str not in self._by_name:
+                return False, (0, f"Unknown opcode '{opcode_str}'")
             return False, (1, f"Invalid number of operands ({len(ops)}) for opcode {opcode_str}.")
-        trial = filtered_trial
 
 
+        #Built straight into the tuple compared against each candidate's precomputed signature
         try:
-            optypes = []
-            for i, o in enumerate(ops):
-                optypes.append(self.get_operand_type(o))
+            optypes = tuple(map(self._operand_types.__getitem__, ops))
         except InvalidOperandException:
-            return False, (i+1, f"Could not determine type of operand {o}")
-        
-        def check_equality(ref, test):
-            _ref = [OperandType.IMM if i in (OperandType.IMM24,OperandType.IMM16) else i for i in ref]
-            return _ref == test
-
-        filtered_trial = [t for t in trial if check_equality(t.ops, optypes)]
-
-        if not filtered_trial:
-            found = [OPTYPES[ot] for ot in optypes]
-            msg = f"Operand types do not match expected format for opcode {opcode_str}.\n"
-            expected = []
-            for exp in trial:
-                expected.append('['+(','.join([OPTYPES[ot] for ot in exp.ops])) + ']')
-            expected = " or ".join(expected)
-            msg += f"Got: [{','.join(found)}]. Expected {expected}"
-            return False, (1, msg)
-
-        return True, filtered_trial[0]
+            #Only the error path needs to know which operand failed
+            for i, o in enumerate(ops):
+                try:
+                    self.get_operand_type(o)
+                except InvalidOperandException:
+                    return False, (i+1, f"Could not determine type of operand {o}")
+
+        #The outcome depends only on the opcode and operand types, so repeated line shapes are
+        #resolved once. Failed matches are kept as well
+        key = (opcode_str, optypes)
+        result = self._resolved.get(key)
+        if result is None:
+            result = self._resolved[key] = self._resolve(opcode_str, trial, optypes)
+        return result
+
+    def _resolve(self, opcode_str: str, trial: list[InstructionDefinition], optypes: tuple[OperandType,...]) -> tuple[bool,tuple[int,str]|InstructionDefinition]:
+        #Usually a single candidate is left by this point, so return on the first match rather
+        #than filtering the whole list
+        for t in trial:
+            if t.ops_normalized == optypes:
+                if t.shifts[-1] < 0:
+                    return False, (0, f"Operands of {opcode_str} do not fit in a 32-bit instruction.")
+                return True, t
+
+        found = [OPTYPES[ot] for ot in optypes]
+        msg = f"Operand types do not match expected format for opcode {opcode_str}.\n"
+        expected = []
+        for exp in trial:
+            expected.append('['+(','.join([OPTYPES[ot] for ot in exp.ops])) + ']')
+        expected = " or ".join(expected)
+        msg += f"Got: [{','.join(found)}]. Expected {expected}"
+        return False, (1, msg)
 
     def get_operand_type(self, operand: str) -> OperandType:
-        if operand in self.registers:
+        if operand in self._reg_index:
             return OperandType.REG
-        if operand[0].isupper() and all(i.isdigit() or i.isupper() for i in operand):
+        if _LAB_RE.fullmatch(operand):
             return OperandType.LAB
-        if all(i.isdigit() for i in operand) or\
-            len(operand) >= 3 and operand[0:2] == "0x" and (i.isdigit() for i in operand[2:]):
+        if _IMM_RE.fullmatch(operand):
             return OperandType.IMM
         
         raise InvalidOperandException
 
     def get_reg_encoding(self, reg: str) -> int:
         try:
-            return self.registers.index(reg)
-        except ValueError:
+            return self._reg_index[reg]
+        except KeyError:
             print(f"Internal error, tried to look up encoding of unknown register {reg}. This should not happen.")
             exit(1)
 
-    def all_instructions(self):
-        for i in self.instructions.instr_gen():
-            yield i
-        for p in self.pipes:
-            for i in p.instructions.instr_gen():
-                yield i            
+    def all_instructions(self) -> list[InstructionDefinition]:
+        return self.instructions_flat
 
         
 from jinja2 import Environment, FileSystemLoader
+
+@lru_cache(maxsize=4)
+def _get_environment(template_path: str) -> Environment:
+    #One environment per templates directory, shared between Formatters. Its template cache keeps
+    #each compiled template, and templates do not change during a run, so the mtime checks are
+    #skipped. Output is C++, so nothing needs escaping
+    return Environment(loader=FileSystemLoader(template_path), auto_reload=False, autoescape=False)
+
+def _render_and_write(template, context: dict, path: str):
+    #Streamed into the file buffer rather than built up as one string first
+    with open(path, "w", buffering=1<<20, encoding="utf-8") as f:
+        template.stream(context).dump(f)
+
 class Formatter:
     def __init__(self, isa: ISADefinition, template_path: Path):
         self.isa = isa
@@ -342,67 +545,64 @@ class Formatter:
 //************************************************//
 """        
 
-        header_template = Environment(loader=FileSystemLoader(self.template_path)).get_template("cpp_def.h.j2")
-        header_data = header_template.render({
+        instrs = self.isa.instructions_flat
+        #Plain (name, encoding) rows, so the opcode loops do no attribute lookups in the template
+        opcodes = [(i.internal_name, i.encoding) for i in instrs]
+        env = _get_environment(str(self.template_path))
+        header_template = env.get_template("cpp_def.h.j2")
+        header_ctx = {
             "warning": warning,
             "namespace": namespace,
-            "instructions": [i for i in self.isa.all_instructions()],
-            "max_opcode_len": max([len(i.internal_name) for i in self.isa.all_instructions()]),
+            "instructions": instrs,
+            "opcodes": opcodes,
+            "max_opcode_len": max(len(name) for name, _ in opcodes),
             "registers": self.isa.registers,
             "flags": self.isa.flags,
             "pipes": self.isa.pipes,
             "mem_size_mb": self.isa.memory_size,
             "mem_access_width_bytes": self.isa.memory_width,
-        })
+        }
 
-        imp_template = Environment(loader=FileSystemLoader(self.template_path)).get_template("cpp_def.cpp.j2")
-        imp_data = imp_template.render({
+        imp_template = env.get_template("cpp_def.cpp.j2")
+        imp_ctx = {
             "warning": warning,
             "namespace": namespace,
             "header": Path(output_file).stem,
-            "instructions": [i for i in self.isa.all_instructions()],
+            "instructions": instrs,
+            "opcodes": opcodes,
             "registers": self.isa.registers,
             "flags": self.isa.flags,
-        })
+        }
 
-        with open(output_file+".h", "w") as f:
-            f.write(header_data)
-        with open(output_file+".cpp", "w") as f:
-            f.write(imp_data)
+        _render_and_write(header_template, header_ctx, output_file+".h")
+        _render_and_write(imp_template, imp_ctx, output_file+".cpp")
 
-    def render_table(self, output_file):
+    def render_table(self, output_file=None):
 
-        disp_instrs = []
-        headers = [" Name ", " Operands ", " Flags ", " Encoding ", " Description "]
+        headers = (" Name ", " Operands ", " Flags ", " Encoding ", " Description ")
         max_widths = [len(h) for h in headers]
 
-        disp_instrs = []
-        for i in self.isa.all_instructions():
-            line = [i.name, ','.join([OPTYPES[o] for o in i.ops]), ",".join(i.flags), hex(i.encoding), i.desc]
-            line = [" "+c+" " for c in line]
-            disp_instrs.append(line) 
-        
-        for line in disp_instrs:
-            for i,l in enumerate(line):
-                max_widths[i] = max(max_widths[i],len(l))
-
-        for line in disp_instrs:
-            for i,l in enumerate(line):
-                l = l + " "*(max_widths[i]-len(l))
-                line[i] = l
-
-        for i,h in enumerate(headers):
-            h = h + " "*(max_widths[i]-len(h))
-            headers[i] = h    
-
-
-        data = "|" + "|".join(headers) + "|\n"
-        sep = ["-"*len(h) for h in headers]
-        data += "|" + "|".join(sep) + "|\n"
-        for i in disp_instrs:
-            data += "|" + "|".join(i) + "|\n"
-
-        print(data)
+        #Rows are built and measured in the same pass
+        rows = []
+        for i in self.isa.instructions_flat:
+            row = (f" {i.name} ", f" {','.join(OPTYPES[o] for o in i.ops)} ", f" {','.join(i.flags)} ", f" {hex(i.encoding)} ", f" {i.desc} ")
+            for k, cell in enumerate(row):
+                max_widths[k] = max(max_widths[k], len(cell))
+            rows.append(row)
+
+        parts = [
+            "|" + "|".join(h.ljust(w) for h, w in zip(headers, max_widths)) + "|",
+            "|" + "|".join("-"*w for w in max_widths) + "|",
+        ]
+        parts.extend("|" + "|".join(c.ljust(w) for c, w in zip(row, max_widths)) + "|" for row in rows)
+        data = "\n".join(parts) + "\n"
+
+        #Written in one go, to stdout when no file is given
+        if output_file:
+            Path(output_file).write_text(data, encoding="utf-8")
+        else:
+            sys.stdout.write(data)
+            sys.stdout.flush()
 
 from argparse import ArgumentParser
 def main():
@@ -444,7 +644,7 @@ def main():
         formatter.render_cpp(args.cpp, args.namespace)
     
     if args.table:
-        formatter.render_table("defs.md")
+        formatter.render_table()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file